@@ -1 +1,3 @@
 list_data_elements = ["pikOziyCXbM", "x3Do5e7g4Qo"]
+dhis2_connection = "dhis2-connection"
+dhis2_timeout = (10, 300)
@@ -1,14 +1,39 @@
 """Extract data from DHIS2."""
 
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
 from openhexa.sdk import current_run, pipeline, parameter, workspace
 from openhexa.toolbox.dhis2 import DHIS2
 
 import pandas as pd
+import polars as pl
+from requests.adapters import HTTPAdapter
 
 
 import config
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter applying a default timeout to the requests sent without one.
+
+    Parameters
+    ----------
+    timeout : tuple[float, float]
+        The connect and read timeouts, in seconds.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["timeout"]
+
+    def __init__(self, timeout: tuple[float, float], *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
 @pipeline("Data Extraction Leyre")
 @parameter(
     "org_units",
@@ -35,23 +60,32 @@ import config
     required=True,
     type=str,
 )
-def data_extraction_leyre(org_units, start_date, end_date):
+@parameter(
+    "output_format",
+    name="Output Format",
+    help="The format of the output file",
+    choices=["parquet", "csv"],
+    default="parquet",
+    required=True,
+    type=str,
+)
+def data_extraction_leyre(org_units, start_date, end_date, output_format):
     """
-    Extract data from DHIS2 and save it to a CSV file.
+    Extract data from DHIS2 and save it to a Parquet or CSV file.
     """
     dhis2 = get_dhis2()
     periods = get_periods(start_date, end_date)
     elements = get_elements(dhis2, org_units, periods)
     df_elements = format_elements(elements)
     df_final = format_df(df_elements, dhis2)
-    file_name = create_file_name(org_units, start_date, end_date)
+    file_name = create_file_name(org_units, start_date, end_date, output_format)
     save_file(file_name, df_final)
 
 
 @data_extraction_leyre.task
-def get_dhis2(con_name: str = "dhis2-connection"):
+def get_dhis2(con_name: str = config.dhis2_connection):
     """
-    Initialize the DHIS2 connection.
+    Initialize the DHIS2 connection, with a timeout on every request.
 
     Parameters
     ----------
@@ -65,21 +99,75 @@ def get_dhis2(con_name: str = "dhis2-connection"):
 
     """
     con_dhis = workspace.dhis2_connection(con_name)
+    dhis2 = DHIS2(con_dhis)
 
-    return DHIS2(con_dhis)
+    adapter = TimeoutHTTPAdapter(timeout=config.dhis2_timeout)
+    dhis2.api.session.mount("https://", adapter)
+    dhis2.api.session.mount("http://", adapter)
+
+    return dhis2
 
 
 @data_extraction_leyre.task
-def get_elements(dhis2: DHIS2, org_units: list[str], periods: list[str]):
-    elements = dhis2.analytics.get(
+def get_elements(dhis2: DHIS2, org_units: list[str], periods: list[str]) -> list[dict]:
+    """
+    Get the analytics values, requesting the chunks of the query concurrently.
+
+    Parameters
+    ----------
+    dhis2 : DHIS2
+        The DHIS2 instance.
+    org_units : list[str]
+        The org units.
+    periods : list[str]
+        The periods in YYYYMM format.
+
+    Returns
+    -------
+    list[dict]
+        The analytics values.
+
+    """
+    if not periods:
+        raise ValueError("No temporal dimension provided. Check that the start date is not after the end date.")
+
+    dimension = dhis2.analytics.format_dimension_param(
         data_elements=config.list_data_elements,
         periods=periods,
         org_units=org_units,
     )
+    params = {"dimension": dimension, "paging": True, "ignoreLimit": True, "skipMeta": True}
+    list_chunks = dhis2.analytics.split_params(params)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list_responses = list(executor.map(lambda chunk: get_analytics_chunk(dhis2, chunk), list_chunks))
+
+    response = dhis2.analytics.merge_chunked_responses(list_responses)
+    elements = dhis2.analytics.to_data_values(response)
     return elements
 
 
-@data_extraction_leyre.task
+def get_analytics_chunk(dhis2: DHIS2, params: dict) -> dict:
+    """
+    Get all the pages of one chunk of the analytics query.
+
+    Parameters
+    ----------
+    dhis2 : DHIS2
+        The DHIS2 instance.
+    params : dict
+        The request parameters of the chunk.
+
+    Returns
+    -------
+    dict
+        The merged response of the chunk.
+
+    """
+    pages = list(dhis2.api.get_paged("analytics", params=params))
+    return dhis2.api.merge_pages(pages)
+
+
 def get_periods(start_date: str, end_date: str) -> list[str]:
     """
     Get the periods between start_date and end_date. The end_date is included.
@@ -97,13 +185,38 @@ def get_periods(start_date: str, end_date: str) -> list[str]:
         A list of periods in YYYYMM format.
 
     """
-    start = pd.to_datetime(start_date, format="%Y%m")
-    end = pd.to_datetime(end_date, format="%Y%m") + pd.offsets.MonthEnd(0)
-    list_periods = pd.date_range(start, end, freq="ME").strftime("%Y%m").tolist()
+    year, month = parse_month(start_date)
+    end_year, end_month = parse_month(end_date)
+
+    list_periods = []
+    while (year, month) <= (end_year, end_month):
+        list_periods.append(f"{year:04d}{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
 
     return list_periods
 
 
+def parse_month(date: str) -> tuple[int, int]:
+    """
+    Split a YYYYMM date into its year and month.
+
+    Parameters
+    ----------
+    date : str
+        The date in YYYYMM format.
+
+    Returns
+    -------
+    tuple[int, int]
+        The year and the month.
+
+    """
+    if len(date) != 6 or not date.isdigit() or not 1 <= int(date[4:]) <= 12:
+        raise ValueError(f"Date {date} is not in YYYYMM format.")
+
+    return int(date[:4]), int(date[4:])
+
+
 @data_extraction_leyre.task
 def format_elements(elements: list[dict]) -> pd.DataFrame:
     """
@@ -120,11 +233,7 @@ def format_elements(elements: list[dict]) -> pd.DataFrame:
         A dataframe with the elements.
 
     """
-    list_df = []
-    for element in elements:
-        list_df.append(pd.DataFrame([element]))
-
-    df = pd.concat(list_df, ignore_index=True)
+    df = pd.DataFrame(elements)
     return df
 
 
@@ -171,6 +280,42 @@ def format_df(df: pd.DataFrame, dhis2: DHIS2) -> pd.DataFrame:
     df = get_metadata_info(dhis2, df)
     df = df.rename(columns=dict_rename)
     df = df[list_output]
+    df = reduce_memory_usage(df)
+
+    return df
+
+
+def reduce_memory_usage(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Store the repeated codes and names as categories and the values as strings.
+
+    The values are kept exactly as DHIS2 returns them, so that integer counts and
+    non-numeric values (booleans, text) are written unchanged, with the same
+    string schema on every run.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The formatted DataFrame.
+
+    Returns
+    -------
+    pd.DataFrame
+        The DataFrame with lighter dtypes.
+
+    """
+    list_categories = [
+        "dataElement",
+        "dataElementName",
+        "CategoryOption",
+        "categoryOptionComboName",
+        "orgUnit",
+        "orgUnitName",
+        "period",
+    ]
+
+    df = df.astype({column: "category" for column in list_categories})
+    df["value"] = df["value"].astype("string")
 
     return df
 
@@ -181,6 +326,8 @@ def get_metadata_info(dhis2: DHIS2, df: pd.DataFrame) -> pd.DataFrame:
 
     Parameters
     ----------
+    dhis2 : DHIS2
+        The DHIS2 instance.
     df : pd.DataFrame
         The DataFrame to format.
 
@@ -190,15 +337,56 @@ def get_metadata_info(dhis2: DHIS2, df: pd.DataFrame) -> pd.DataFrame:
         The DataFrame with the metadata names.
 
     """
-    df = dhis2.meta.add_org_unit_name_column(dataframe=df)
-    df = dhis2.meta.add_dx_name_column(dataframe=df)
-    df = dhis2.meta.add_coc_name_column(dataframe=df)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        future_ou = executor.submit(get_names, dhis2.meta.organisation_units, df["ou"])
+        future_de = executor.submit(get_names, dhis2.meta.data_elements, df["dx"])
+        future_in = executor.submit(get_names, dhis2.meta.indicators, df["dx"])
+        future_co = executor.submit(get_names, dhis2.meta.category_option_combos, df["co"])
+
+    ou_names = future_ou.result()
+    dx_names = future_de.result() | future_in.result()
+    co_names = future_co.result()
+
+    df = df.assign(
+        ou_name=df["ou"].map(ou_names),
+        dx_name=df["dx"].map(dx_names),
+        co_name=df["co"].map(co_names),
+    )
 
     return df
 
 
-@data_extraction_leyre.task
-def create_file_name(org_units: list[str], start_date: str, end_date: str) -> str:
+def get_names(get_metadata, ids: pd.Series, batch_size: int = 50) -> dict[str, str]:
+    """
+    Fetch the names of the given codes, in batches to keep the request URLs short.
+
+    Parameters
+    ----------
+    get_metadata : callable
+        The DHIS2 metadata accessor, e.g. dhis2.meta.organisation_units.
+    ids : pd.Series
+        The codes to look up.
+    batch_size : int
+        The maximum number of codes per metadata request.
+
+    Returns
+    -------
+    dict[str, str]
+        A mapping from code to name.
+
+    """
+    list_ids = ids.dropna().unique().tolist()
+
+    names = {}
+    for i in range(0, len(list_ids), batch_size):
+        batch = list_ids[i : i + batch_size]
+        metadata = get_metadata(fields="id,name", filters=[f"id:in:[{','.join(batch)}]"])
+        names.update({item["id"]: item["name"] for item in metadata})
+
+    return names
+
+
+def create_file_name(org_units: list[str], start_date: str, end_date: str, output_format: str = "parquet") -> str:
     """
     Create the file name.
 
@@ -210,6 +398,8 @@ def create_file_name(org_units: list[str], start_date: str, end_date: str) -> st
         The start date.
     end_date : str
         The end date.
+    output_format : str
+        The file extension, "parquet" or "csv".
 
     Returns
     -------
@@ -217,17 +407,40 @@ def create_file_name(org_units: list[str], start_date: str, end_date: str) -> st
         The file name.
 
     """
-    org_units = ",".join(org_units)
-    data_elements = ",".join(config.list_data_elements)
-    file_name = f"dataextraction_ous-{org_units}_elements-{data_elements}_periods-{start_date}_{end_date}.csv"
+    org_units = join_codes(org_units)
+    data_elements = join_codes(config.list_data_elements)
+    file_name = f"dataextraction_ous-{org_units}_elements-{data_elements}_periods-{start_date}_{end_date}.{output_format}"
     path = f"{workspace.files_path}/" + file_name
     return path
 
 
+def join_codes(codes: list[str], max_codes: int = 3) -> str:
+    """
+    Join the codes for the file name, hashing them when there are too many.
+
+    Parameters
+    ----------
+    codes : list[str]
+        The codes.
+    max_codes : int
+        The maximum number of codes written as they are.
+
+    Returns
+    -------
+    str
+        The joined codes, or a short deterministic hash of them.
+
+    """
+    if len(codes) <= max_codes:
+        return ",".join(codes)
+
+    return hashlib.blake2b(",".join(sorted(codes)).encode(), digest_size=8).hexdigest()
+
+
 @data_extraction_leyre.task
 def save_file(file_name: str, df: pd.DataFrame) -> None:
     """
-    Save the file.
+    Save the file, as Parquet or CSV depending on its extension.
 
     Parameters
     ----------
@@ -236,7 +449,11 @@ def save_file(file_name: str, df: pd.DataFrame) -> None:
     df : pd.DataFrame
         The DataFrame to save.
     """
-    df.to_csv(file_name, index=False)
+    df_pl = pl.from_pandas(df)
+    if file_name.endswith(".parquet"):
+        df_pl.write_parquet(file_name, compression="snappy")
+    else:
+        df_pl.write_csv(file_name)
     current_run.add_file_output(file_name)
     print(f"File {file_name} saved.")
 
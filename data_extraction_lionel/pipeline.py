@@ -1,10 +1,35 @@
 """Import relevant packages."""
 from openhexa.sdk import pipeline, parameter, workspace, current_run
 from openhexa.toolbox.dhis2 import DHIS2
-from openhexa.toolbox.dhis2.dataframe import extract_dataset, get_data_elements
+from openhexa.toolbox.dhis2.dataframe import extract_dataset
 
 import polars as pl
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+
+# Name of the DHIS2 connection in the workspace
+DHIS2_CONNECTION = "dhis2"
+
+# Connect and read timeouts (in seconds) so a stalled DHIS2 call cannot hang the pipeline
+DHIS2_TIMEOUT = (10, 300)
+
+# Diseases of interest and the matching DHIS2 name filters, built once at import
+DISEASES = ["mpox", "cholera", "covid"]
+DISEASE_FILTER = [f"name:ilike:{disease}" for disease in DISEASES]
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter applying a default timeout to the requests sent without one."""
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["timeout"]
+
+    def __init__(self, timeout, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
 
 #--------------------------------------------------
 # Define the pipeline for DHIS2 data extraction
@@ -15,9 +40,11 @@ from datetime import datetime
            type=str, required=True)
 @parameter("end_date", name="End date for DHIS2 data extraction", default="2025-01-31",
            type=str, required=True)
-@parameter("org_unit_id", name="Organization Unit ID for DHIS2 data extraction",
-           default="rdX5nU5lrcx", type=str, required=True)
-def dhis2_data_extraction_lionel(start_date: str, end_date: str, org_unit_id: str):
+@parameter("org_unit_id", name="Organization Unit IDs for DHIS2 data extraction",
+           help="One or more organization unit IDs, extracted together in a single run. "
+                "Takes a list of IDs: configs passing a single ID as a plain string must wrap it in a list.",
+           default=["rdX5nU5lrcx"], type=str, multiple=True, required=True)
+def dhis2_data_extraction_lionel(start_date: str, end_date: str, org_unit_id: list[str]):
     """
     Extract data set values underlying DHIS2 DSNIS and filter for specific diseases.
     """
@@ -36,8 +63,12 @@ def connect_to_dhis2():
     """Set up connection to DHIS2."""
     current_run.log_info("Connecting to DHIS2...")
     # Retrieve the DHIS2 connection from the workspace
-    dhis2_connection=workspace.dhis2_connection("dhis2")
+    dhis2_connection=workspace.dhis2_connection(DHIS2_CONNECTION)
     dhis2=DHIS2(dhis2_connection)
+    # The toolbox session sends requests without any timeout, so add one
+    adapter=TimeoutHTTPAdapter(timeout=DHIS2_TIMEOUT)
+    dhis2.api.session.mount("https://", adapter)
+    dhis2.api.session.mount("http://", adapter)
     return dhis2
 
 @dhis2_data_extraction_lionel.task
@@ -52,44 +83,55 @@ def extract_dsnis_simr_dataset_id(group_name: str, connection):
             "filter": f"name:ilike:{group_name}"
         }
     )
+    # Fail with an explicit message instead of an IndexError when the name matches no dataset
+    if not data_set['dataSets']:
+        raise ValueError(f"No DHIS2 dataset found matching name: {group_name}")
     ds_id=data_set['dataSets'][0]['id']
     return ds_id
 
 @dhis2_data_extraction_lionel.task
 def retrieve_relevant_data_element_ids(connection):
     """Retrieve all data elements IDs relating to mpox, cholera, or covid."""
-    current_run.log_info("Retrieving data element IDs related to mpox, cholera, or covid")
-    # Retrieve all data elements and filter for specific diseases
-    df=get_data_elements(connection)
-    filttered_df=df.filter(
-    pl.col("name").str.contains("(?i)mpox|cholera|covid")
+    current_run.log_info(f"Retrieving data element IDs related to {', '.join(DISEASES)}")
+    # Let DHIS2 filter the data elements on their name instead of downloading all of them
+    data_elements = connection.api.get(
+        endpoint="dataElements",
+        params={
+            "fields": "id",
+            "filter": DISEASE_FILTER,
+            "rootJunction": "OR",
+            "paging": "false"
+        }
     )
-    de_ids=filttered_df['id'].to_list()
+    de_ids=pl.Series("de_ids", [de["id"] for de in data_elements["dataElements"]], dtype=pl.Utf8)
     return de_ids
 
 @dhis2_data_extraction_lionel.task
-def retrieve_data_set(connection, dataset_id: str, start_date: str, end_date: str, org_unit_id: str, de_ids: str):
+def retrieve_data_set(connection, dataset_id: str, start_date: str, end_date: str, org_unit_id: list[str], de_ids: pl.Series):
     """Retrieve dataset information relating to the 3 diseases"""
-    current_run.log_info(f"Retrieving dataset values associated with relevant data elements for org unit ID {org_unit_id} from {start_date} to {end_date}")
+    current_run.log_info(f"Retrieving dataset values associated with relevant data elements for org unit IDs {', '.join(org_unit_id)} from {start_date} to {end_date}")
 
-    # Convert org_unit_id from string to list (as required by the extract_dataset function)
-    org_unit_id_list = [org_unit_id]
+    # Skip the extraction altogether when no data element matches the diseases
+    if de_ids.is_empty():
+        current_run.log_warning("No relevant data element found, skipping dataset extraction")
+        return pl.DataFrame()
 
     # Convert start and end dates from string to datetime objects
     start_date_formatted = datetime.strptime(start_date, "%Y-%m-%d")
     end_date_formatted = datetime.strptime(end_date,   "%Y-%m-%d")
 
-    # Extract dataset values for the specified dataset ID, date range, and org unit IDs
+    # Extract dataset values for the specified dataset ID, date range, and all org unit IDs in a single call
     ds_values = extract_dataset(
         dhis2=connection,
         dataset=dataset_id,
         start_date=start_date_formatted,
         end_date=end_date_formatted,
-        org_units=org_unit_id_list,
+        org_units=org_unit_id,
         include_children = True,
         org_unit_groups=None,
     )
-    ds_values_filtered=ds_values.filter(pl.col("data_element_id").is_in(de_ids))
+    # Keep only values of the relevant data elements
+    ds_values_filtered=ds_values.filter(pl.col("data_element_id").is_in(de_ids.implode()))
     return ds_values_filtered
 
 if __name__ == "__main__":